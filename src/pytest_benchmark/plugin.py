@@ -222,6 +222,23 @@ def pytest_addoption(parser):
         help="Use this to make --benchmark-save and --benchmark-autosave include all the timing data,"
              " not just the stats.",
     )
+    group.addoption(
+        "--benchmark-elasticsearch-chunk-size",
+        metavar="NUM", type=int, default=500,
+        help="Number of documents sent in a single bulk request when saving to elasticsearch storage."
+             " Default: %(default)r"
+    )
+    group.addoption(
+        "--benchmark-elasticsearch-thread-count",
+        metavar="NUM", type=int, default=4,
+        help="Number of threads used to send bulk requests when saving to elasticsearch storage."
+             " Default: %(default)r"
+    )
+    group.addoption(
+        "--benchmark-elasticsearch-tune-indexing",
+        action="store_true", default=False,
+        help="Relax the refresh interval and translog durability of the elasticsearch index while saving."
+    )
     group.addoption(
         "--benchmark-json",
         metavar="PATH", type=argparse.FileType('wb'),
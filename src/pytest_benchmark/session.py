@@ -44,7 +44,10 @@ class BenchmarkSession(object):
             config.getoption("benchmark_storage"),
             logger=self.logger,
             default_machine_id=self.machine_id,
-            netrc=config.getoption("benchmark_netrc")
+            netrc=config.getoption("benchmark_netrc"),
+            elasticsearch_bulk_chunk_size=config.getoption("benchmark_elasticsearch_chunk_size"),
+            elasticsearch_thread_count=config.getoption("benchmark_elasticsearch_thread_count"),
+            elasticsearch_tune_indexing=config.getoption("benchmark_elasticsearch_tune_indexing"),
         )
         self.options = dict(
             min_time=SecondsDecimal(config.getoption("benchmark_min_time")),
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import operator
 import re
 import uuid
 from datetime import date
@@ -11,10 +12,20 @@ from ..stats import normalize_stats
 
 try:
     import elasticsearch
+    from elasticsearch import helpers
     from elasticsearch.serializer import JSONSerializer
 except ImportError:
     raise ImportError("Please install elasticsearch or pytest-benchmark[elasticsearch]")
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# elasticsearch-py 7 serializers return str, the bulk helpers encode it themselves
+_SERIALIZER_RETURNS_BYTES = elasticsearch.VERSION >= (8,)
+
 
 class BenchmarkJSONSerializer(JSONSerializer):
     def default(self, data):
@@ -27,6 +38,21 @@ class BenchmarkJSONSerializer(JSONSerializer):
         else:
             return "UNSERIALIZABLE[%r]" % data
 
+    def dumps(self, data):
+        if orjson is None or isinstance(data, (str, bytes)):
+            return super(BenchmarkJSONSerializer, self).dumps(data)
+        try:
+            dumped = orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson rejects some values the json module handles (integers over 64 bits, for one)
+            return super(BenchmarkJSONSerializer, self).dumps(data)
+        return dumped if _SERIALIZER_RETURNS_BYTES else dumped.decode()
+
+    def loads(self, data):
+        if orjson is None or not data:
+            return super(BenchmarkJSONSerializer, self).loads(data)
+        return orjson.loads(data)
+
 
 def _mask_hosts(hosts):
     m = re.compile('^([^:]+)://[^@]+@')
@@ -35,19 +61,224 @@ def _mask_hosts(hosts):
     return masked_hosts
 
 
+# the connection pool and timeout options got renamed in elasticsearch-py 8
+if elasticsearch.VERSION >= (8,):
+    _CLIENT_CONNECTION_OPTIONS = dict(connections_per_node=25, request_timeout=30)
+else:
+    _CLIENT_CONNECTION_OPTIONS = dict(maxsize=25, timeout=30)
+
+# shared by all the searches, never mutated
+_SEARCH_SORT = [
+    {
+        "datetime": {
+            "order": "asc"
+        }
+    }
+]
+
+# used around bulk uploads when tune_indexing is enabled: refresh less often and don't fsync the translog on every
+# request, then reset both to the index defaults
+_BULK_INDEX_SETTINGS = {
+    "index": {
+        "refresh_interval": "30s",
+        "translog.durability": "async",
+    }
+}
+_DEFAULT_INDEX_SETTINGS = {
+    "index": {
+        "refresh_interval": None,
+        "translog.durability": None,
+    }
+}
+
+_BENCHMARK_KEYS = ("group", "stats", "options", "param", "name", "params", "fullname", "benchmark_id")
+_get_benchmark_values = operator.itemgetter(*_BENCHMARK_KEYS)
+_RUN_KEYS = ("machine_info", "commit_info", "datetime", "version")
+_get_run_values = operator.itemgetter(*_RUN_KEYS)
+# only fetch the fields the records are built from
+_SEARCH_SOURCE = list(_BENCHMARK_KEYS + _RUN_KEYS)
+
+_INDEX_MAPPING = {
+    "mappings": {
+        "properties": {
+            "commit_info": {
+                "properties": {
+                    "dirty": {
+                        "type": "boolean"
+                    },
+                    "id": {
+                        "type": "keyword"
+                    },
+                    "project": {
+                        "type": "keyword"
+                    }
+                }
+            },
+            "datetime": {
+                "type": "date",
+                "format": "strict_date_optional_time||epoch_millis"
+            },
+            "name": {
+                "type": "keyword"
+            },
+            "fullname": {
+                "type": "keyword"
+            },
+            "version": {
+                "type": "keyword"
+            },
+            "benchmark_id": {
+                "type": "keyword",
+            },
+            "machine_info": {
+                "properties": {
+                    "machine": {
+                        "type": "keyword"
+                    },
+                    "node": {
+                        "type": "keyword"
+                    },
+                    "processor": {
+                        "type": "keyword"
+                    },
+                    "python_build": {
+                        "type": "keyword"
+                    },
+                    "python_compiler": {
+                        "type": "keyword"
+                    },
+                    "python_implementation": {
+                        "type": "keyword"
+                    },
+                    "python_implementation_version": {
+                        "type": "keyword"
+                    },
+                    "python_version": {
+                        "type": "keyword"
+                    },
+                    "release": {
+                        "type": "keyword"
+                    },
+                    "system": {
+                        "type": "keyword"
+                    }
+                }
+            },
+            "options": {
+                "properties": {
+                    "disable_gc": {
+                        "type": "boolean"
+                    },
+                    "max_time": {
+                        "type": "double"
+                    },
+                    "min_rounds": {
+                        "type": "long"
+                    },
+                    "min_time": {
+                        "type": "double"
+                    },
+                    "timer": {
+                        "type": "text"
+                    },
+                    "warmup": {
+                        "type": "boolean"
+                    }
+                }
+            },
+            "stats": {
+                "properties": {
+                    "hd15iqr": {
+                        "type": "double"
+                    },
+                    "iqr": {
+                        "type": "double"
+                    },
+                    "iqr_outliers": {
+                        "type": "long"
+                    },
+                    "iterations": {
+                        "type": "long"
+                    },
+                    "ld15iqr": {
+                        "type": "double"
+                    },
+                    "max": {
+                        "type": "double"
+                    },
+                    "mean": {
+                        "type": "double"
+                    },
+                    "median": {
+                        "type": "double"
+                    },
+                    "min": {
+                        "type": "double"
+                    },
+                    "outliers": {
+                        "type": "text"
+                    },
+                    "q1": {
+                        "type": "double"
+                    },
+                    "q3": {
+                        "type": "double"
+                    },
+                    "rounds": {
+                        "type": "long"
+                    },
+                    "stddev": {
+                        "type": "double"
+                    },
+                    "stddev_outliers": {
+                        "type": "long"
+                    },
+                    "ops": {
+                        "type": "double"
+                    },
+                }
+            },
+        }
+    }
+}
+
+
 class ElasticsearchStorage(object):
+    # clients (and their connection pools) are shared by all the instances that use the same hosts
+    _client_cache = {}
+    # (hosts, index) pairs that already went through _create_index in this process
+    _indexes_created = set()
+
     def __init__(self, hosts, index, doctype, project_name, logger,
-                 default_machine_id=None):
+                 default_machine_id=None, bulk_chunk_size=500, thread_count=4, tune_indexing=False):
         self._es_hosts = hosts
         self._es_index = index
-        self._es_doctype = doctype
-        self._es = elasticsearch.Elasticsearch(self._es_hosts, serializer=BenchmarkJSONSerializer())
+        self._es_doctype = doctype  # not used anymore (typeless API), kept for backwards compatibility
+        self._es = self._get_client(self._es_hosts)
         self._project_name = project_name
+        self._bulk_chunk_size = bulk_chunk_size
+        self._thread_count = thread_count
+        self._tune_indexing = tune_indexing
+        self._pending = []
         self.default_machine_id = default_machine_id
         self.logger = logger
         self._cache = {}
         self._create_index()
 
+    @classmethod
+    def _get_client(cls, hosts):
+        key = tuple(hosts)
+        client = cls._client_cache.get(key)
+        if client is None:
+            client = cls._client_cache[key] = elasticsearch.Elasticsearch(
+                hosts,
+                serializer=BenchmarkJSONSerializer(),
+                http_compress=True,
+                retry_on_timeout=True,
+                **_CLIENT_CONNECTION_OPTIONS
+            )
+        return client
+
     def __str__(self):
         return str(self._es_hosts)
 
@@ -57,44 +288,67 @@ class ElasticsearchStorage(object):
 
     def query(self):
         """
-        Returns sorted records names (ids) that corresponds with project.
+        Yield sorted records names (ids) that corresponds with project.
         """
+        # composite buckets come sorted by key
+        for bucket in self._search_groups(self._project_name):
+            yield bucket["key"]["benchmark_id"]
+
+    def _search_groups(self, project):
         body = {
             "size": 0,
+            "query": {
+                "bool": {
+                    "filter": {
+                        "term": {
+                            "commit_info.project": project
+                        }
+                    }
+                }
+            },
             "aggs": {
                 "benchmark_ids": {
-                    "terms": {
-                        "field": "benchmark_id"
+                    "composite": {
+                        "size": 1000,
+                        "sources": [
+                            {
+                                "benchmark_id": {
+                                    "terms": {
+                                        "field": "benchmark_id"
+                                    }
+                                }
+                            }
+                        ]
                     }
                 }
             }
         }
-        result = self._es.search(index=self._es_index, doc_type=self._es_doctype, body=body)
-        return sorted([record["key"] for record in result["aggregations"]["benchmark_ids"]["buckets"]])
+        while True:
+            result = self._es.search(index=self._es_index, body=body)
+            aggregation = result["aggregations"]["benchmark_ids"]
+            for bucket in aggregation["buckets"]:
+                yield bucket
+            if not aggregation["buckets"] or "after_key" not in aggregation:
+                break
+            body["aggs"]["benchmark_ids"]["composite"]["after"] = aggregation["after_key"]
 
     def load(self, id_prefix=None):
         """
         Yield key and content of records that corresponds with project name.
+
+        Apart from the stats, nested data is shared with the cached search results and must be treated as read-only.
         """
-        r = self._search(self._project_name, id_prefix)
-        groupped_data = self._group_by_commit_and_time(r["hits"]["hits"])
-        result = [(key, value) for key, value in groupped_data.items()]
-        result.sort(key=lambda x: datetime.strptime(x[1]["datetime"], "%Y-%m-%dT%H:%M:%S.%f"))
-        for key, data in result:
-            for bench in data["benchmarks"]:
-                normalize_stats(bench["stats"])
-            yield key, data
+        hits = self._search(self._project_name, id_prefix)
+        # hits come sorted by datetime and the grouping keeps that order
+        yield from self._group_by_commit_and_time(hits).items()
 
     def _search(self, project, id_prefix=None):
+        key = project, id_prefix
+        if key in self._cache:
+            return self._cache[key]
         body = {
-            "size": 1000,
-            "sort": [
-                {
-                    "datetime": {
-                        "order": "desc"
-                    }
-                }
-            ],
+            "sort": _SEARCH_SORT,
+            "_source": _SEARCH_SOURCE,
             "query": {
                 "bool": {
                     "filter": {
@@ -112,231 +366,119 @@ class ElasticsearchStorage(object):
                 }
             }
 
-        return self._es.search(index=self._es_index, doc_type=self._es_doctype, body=body)
+        # scroll through all the hits instead of getting a single capped page
+        hits = list(helpers.scan(
+            self._es,
+            query=body,
+            preserve_order=True,
+            size=200,
+            index=self._es_index,
+        ))
+        # only keep the last search, it's the one load() and load_benchmarks() repeat
+        self._cache = {key: hits}
+        return hits
+
+    def invalidate(self, project=None):
+        """
+        Forget cached search results for project (or for all projects if not specified).
+        """
+        for key in list(self._cache):
+            if project is None or key[0] == project:
+                self._cache.pop(key, None)
 
     @staticmethod
     def _benchmark_from_es_record(source_es_record):
-        result = {}
-        for benchmark_key in ("group", "stats", "options", "param", "name", "params", "fullname", "benchmark_id"):
-            result[benchmark_key] = source_es_record[benchmark_key]
-        return result
+        return dict(zip(_BENCHMARK_KEYS, _get_benchmark_values(source_es_record)))
 
     @staticmethod
     def _run_info_from_es_record(source_es_record):
-        result = {}
-        for run_key in ("machine_info", "commit_info", "datetime", "version"):
-            result[run_key] = source_es_record[run_key]
-        return result
+        return dict(zip(_RUN_KEYS, _get_run_values(source_es_record)))
 
     def _group_by_commit_and_time(self, hits):
+        # this runs once per hit, so keep lookups in locals
+        benchmark_from_es_record = self._benchmark_from_es_record
+        run_info_from_es_record = self._run_info_from_es_record
         result = {}
         for hit in hits:
             source_hit = hit["_source"]
-            key = "%s_%s" % (source_hit["commit_info"]["id"], source_hit["datetime"])
-            benchmark = self._benchmark_from_es_record(source_hit)
-            if key in result:
-                result[key]["benchmarks"].append(benchmark)
-            else:
-                run_info = self._run_info_from_es_record(source_hit)
-                run_info["benchmarks"] = [benchmark]
-                result[key] = run_info
+            key = source_hit["commit_info"]["id"] + "_" + source_hit["datetime"]
+            run_info = result.get(key)
+            if run_info is None:
+                run_info = result[key] = run_info_from_es_record(source_hit)
+                run_info["benchmarks"] = []
+            benchmark = benchmark_from_es_record(source_hit)
+            # normalize_stats() writes into the dict, don't let it touch the cached hit
+            benchmark["stats"] = normalize_stats(dict(benchmark["stats"]))
+            run_info["benchmarks"].append(benchmark)
         return result
 
     def load_benchmarks(self, *args):
         """
         Yield benchmarks that corresponds with project. Put path and
         source (uncommon part of path) to benchmark dict.
+
+        Nested data is shared with the cached search results and must be treated as read-only.
         """
         id_prefix = args[0] if args else None
-        r = self._search(self._project_name, id_prefix)
-        for hit in r["hits"]["hits"]:
+        for hit in self._search(self._project_name, id_prefix):
             bench = self._benchmark_from_es_record(hit["_source"])
             bench.update(bench.pop("stats"))
             bench["source"] = bench["benchmark_id"]
             yield bench
 
     def save(self, output_json, save):
-        output_benchmarks = output_json.pop("benchmarks")
-        for bench in output_benchmarks:
-            # add top level info from output_json dict to each record
-            bench.update(output_json)
-            benchmark_id = save
-            if self.default_machine_id:
-                benchmark_id = self.default_machine_id + "_" + benchmark_id
-            doc_id = benchmark_id + "_" + bench["fullname"]
-            bench["benchmark_id"] = benchmark_id
-            self._es.index(
-                index=self._es_index,
-                doc_type=self._es_doctype,
-                body=bench,
-                id=doc_id,
-            )
+        self.invalidate(self._project_name)
+        if self._tune_indexing:
+            # relaxed for the whole upload, restored below
+            self._es.indices.put_settings(index=self._es_index, body=_BULK_INDEX_SETTINGS)
+        try:
+            output_benchmarks = output_json.pop("benchmarks")
+            for bench in output_benchmarks:
+                # add top level info from output_json dict to each record
+                bench.update(output_json)
+                benchmark_id = save
+                if self.default_machine_id:
+                    benchmark_id = self.default_machine_id + "_" + benchmark_id
+                doc_id = benchmark_id + "_" + bench["fullname"]
+                bench["benchmark_id"] = benchmark_id
+                self._pending.append({
+                    "_index": self._es_index,
+                    "_id": doc_id,
+                    "_source": bench,
+                })
+                # buffer enough for every thread to get a chunk of its own
+                if len(self._pending) >= self._bulk_chunk_size * self._thread_count:
+                    self.flush()
+            self.flush()
+        finally:
+            if self._tune_indexing:
+                self._es.indices.put_settings(index=self._es_index, body=_DEFAULT_INDEX_SETTINGS)
         # hide user's credentials before logging
         masked_hosts = _mask_hosts(self._es_hosts)
-        self.logger.info("Saved benchmark data to %s to index %s as doctype %s" % (
-            masked_hosts, self._es_index, self._es_doctype))
+        self.logger.info("Saved benchmark data to %s to index %s" % (masked_hosts, self._es_index))
+
+    def flush(self):
+        """
+        Send the pending documents to elasticsearch using the bulk API, spreading the chunks over a pool of
+        threads.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        for ok, info in helpers.parallel_bulk(self._es, pending,
+                                              thread_count=self._thread_count,
+                                              chunk_size=self._bulk_chunk_size,
+                                              queue_size=4,
+                                              raise_on_error=False):
+            if not ok:
+                self.logger.warn("Failed to save benchmark data to elasticsearch: %r" % info)
 
     def _create_index(self):
-        mapping = {
-            "mappings": {
-                "benchmark": {
-                    "properties": {
-                        "commit_info": {
-                            "properties": {
-                                "dirty": {
-                                    "type": "boolean"
-                                },
-                                "id": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-
-                                },
-                                "project": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                }
-                            }
-                        },
-                        "datetime": {
-                            "type": "date",
-                            "format": "strict_date_optional_time||epoch_millis"
-                        },
-                        "name": {
-                            "type": "string",
-                            "index": "not_analyzed"
-                        },
-                        "fullname": {
-                            "type": "string",
-                            "index": "not_analyzed"
-                        },
-                        "version": {
-                            "type": "string",
-                            "index": "not_analyzed"
-                        },
-                        "benchmark_id": {
-                            "type": "string",
-                            "index": "not_analyzed",
-                        },
-                        "machine_info": {
-                            "properties": {
-                                "machine": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "node": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "processor": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "python_build": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "python_compiler": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "python_implementation": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "python_implementation_version": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "python_version": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "release": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                },
-                                "system": {
-                                    "type": "string",
-                                    "index": "not_analyzed"
-                                }
-                            }
-                        },
-                        "options": {
-                            "properties": {
-                                "disable_gc": {
-                                    "type": "boolean"
-                                },
-                                "max_time": {
-                                    "type": "double"
-                                },
-                                "min_rounds": {
-                                    "type": "long"
-                                },
-                                "min_time": {
-                                    "type": "double"
-                                },
-                                "timer": {
-                                    "type": "string"
-                                },
-                                "warmup": {
-                                    "type": "boolean"
-                                }
-                            }
-                        },
-                        "stats": {
-                            "properties": {
-                                "hd15iqr": {
-                                    "type": "double"
-                                },
-                                "iqr": {
-                                    "type": "double"
-                                },
-                                "iqr_outliers": {
-                                    "type": "long"
-                                },
-                                "iterations": {
-                                    "type": "long"
-                                },
-                                "ld15iqr": {
-                                    "type": "double"
-                                },
-                                "max": {
-                                    "type": "double"
-                                },
-                                "mean": {
-                                    "type": "double"
-                                },
-                                "median": {
-                                    "type": "double"
-                                },
-                                "min": {
-                                    "type": "double"
-                                },
-                                "outliers": {
-                                    "type": "string"
-                                },
-                                "q1": {
-                                    "type": "double"
-                                },
-                                "q3": {
-                                    "type": "double"
-                                },
-                                "rounds": {
-                                    "type": "long"
-                                },
-                                "stddev": {
-                                    "type": "double"
-                                },
-                                "stddev_outliers": {
-                                    "type": "long"
-                                },
-                                "ops": {
-                                    "type": "double"
-                                },
-                            }
-                        },
-                    }
-                }
-            }
-        }
-        self._es.indices.create(index=self._es_index, ignore=400, body=mapping)
+        key = tuple(self._es_hosts), self._es_index
+        if key in ElasticsearchStorage._indexes_created:
+            return
+        if self._es.indices.exists(index=self._es_index):
+            ElasticsearchStorage._indexes_created.add(key)
+            return
+        self._es.indices.create(index=self._es_index, ignore=400, body=_INDEX_MAPPING)
+        ElasticsearchStorage._indexes_created.add(key)
@@ -438,6 +438,10 @@ def load_storage(storage, **kwargs):
     if "://" not in storage:
         storage = "file://" + storage
     netrc_file = kwargs.pop('netrc')  # only used by elasticsearch storage
+    elasticsearch_options = dict(
+        (name[len('elasticsearch_'):], kwargs.pop(name))
+        for name in list(kwargs) if name.startswith('elasticsearch_')
+    )  # only used by elasticsearch storage
     if storage.startswith("file://"):
         from .storage.file import FileStorage
         return FileStorage(storage[len("file://"):], **kwargs)
@@ -447,7 +451,7 @@ def load_storage(storage, **kwargs):
         # TODO update benchmark_autosave
         args = parse_elasticsearch_storage(storage[len("elasticsearch+"):],
                                            netrc_file=netrc_file)
-        return ElasticsearchStorage(*args, **kwargs)
+        return ElasticsearchStorage(*args, **dict(kwargs, **elasticsearch_options))
     else:
         raise argparse.ArgumentTypeError("Storage must be in form of file://path or "
                                          "elasticsearch+http[s]://host1,host2/index/doctype")